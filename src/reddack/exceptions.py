@@ -56,3 +56,6 @@ class ActionSequenceError(SequenceError):
 
 class ConfigError(ModFromSlackError):
     """Error in config file format."""
+
+class KnownItemsError(ModFromSlackError):
+    """Failed to load known items file."""
@@ -1,5 +1,11 @@
 from __future__ import annotations
 import abc
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import os
+import ssl
+import threading
+import time
 from typing import (
     Type,
     Union,
@@ -11,9 +17,8 @@ import json
 # 3rd party imports
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
+from slack_sdk.http_retry import RateLimitErrorRetryHandler
 from praw import Reddit
-from praw.models import Submission
-import jsonpickle
 
 # Local imports
 from reddack.payload import (
@@ -33,13 +38,42 @@ from reddack.utils import (
     get_known_items,
     update_knownitems_file,
     cleanup_knownitems_json,
-    clean_post_request
+    clean_post_request,
+    scan_post_requests
 )
 
 # TODO Add functionality for flairing posts
 # TODO Add functionality for awarding posts
 
 DEFAULT_AGENT =  "Slack moderation interface by u/ModeHopper"
+USERNAME_TTL = 600
+USERNAME_CACHE_SIZE = 512
+REPLIES_PAGE_SIZE = 200
+SEND_WORKERS = 3
+# Each cleanup worker makes one chat.delete call at a time, so this also caps
+# concurrent deletes to stay within Slack's rate limits
+CLEANUP_WORKERS = 4
+
+_username_cache: dict[str, tuple[str, float]] = {}
+_username_lock = threading.Lock()
+
+def _resolve_user_name(client: WebClient, userid: str) -> str:
+    """Retrieve a Slack user's real name, cached for USERNAME_TTL seconds"""
+    with _username_lock:
+        cached = _username_cache.get(userid)
+    if cached is not None and time.monotonic() - cached[1] < USERNAME_TTL:
+        return cached[0]
+    response = client.users_info(user=userid)
+    name = response["user"]["real_name"]
+    now = time.monotonic()
+    with _username_lock:
+        # Re-insert so the dict stays ordered by fetch time, which means the
+        # oldest entry is always the first to expire and the one to evict
+        _username_cache.pop(userid, None)
+        while len(_username_cache) >= USERNAME_CACHE_SIZE:
+            del _username_cache[next(iter(_username_cache))]
+        _username_cache[userid] = (name, now)
+    return name
 
 class ReddackItem:
     """Stores information about the state of an item in the modqueue."""
@@ -48,46 +82,48 @@ class ReddackItem:
         self.message_ts = None
         self.responses: dict[str, ReddackResponse] = {}
 
-    def process_slack_responses(self, postrequest_path: Path): 
-        """Check for responses to mod item message."""
-        requests, timestamps = self.find_post_requests(postrequest_path)
-        if requests:
-            for request, timestamp in zip(requests, timestamps):
-                moderator = request['user']['id']
-                if moderator in self.responses:
-                    self.responses[moderator].update(request, timestamp)
-                else:
-                    self.initialize_response(moderator)
-                    self.responses[moderator].update(request, timestamp)
-
-    def find_post_requests(self, postrequest_path: Path) -> tuple[list[dict], list[str]]:
-        """Retrieves all POST requests for a given mod item, returns sorted list."""
-        recieved_timestamps = []
-        requests = []
-        for postfile in postrequest_path.iterdir():
-            if postfile.suffix == '.json':
-                request_ts = postfile.stem
-                with open(postfile, 'r') as file:
-                    request = json.load(file)
-                if request['container']['message_ts'] == self.message_ts:
-                    recieved_timestamps.append(request_ts)
-                    requests.append(request)
-                else:
-                    continue
-            else:
-                continue
-        if len(recieved_timestamps) == 0:
-            return ((), ())
-        else:
-            sortedrequests, sortedtimestamps = zip(
-                *sorted(zip(requests, recieved_timestamps), 
-                key=lambda z: z[1])
-            )
-            return sortedrequests, sortedtimestamps
+    def __getstate__(self) -> dict:
+        """Return item state as plain JSON-serializable data."""
+        state = dict(vars(self))
+        state['kind'] = self.kind
+        state['responses'] = {
+            moderator: response.__getstate__() 
+            for moderator, response in self.responses.items()
+        }
+        return state
+
+    def __setstate__(self, state: dict):
+        """Restore item state from the output of __getstate__."""
+        state = dict(state)
+        state.pop('kind', None)
+        responses = state.pop('responses', {})
+        vars(self).update(state)
+        self.responses = {}
+        for moderator, responsestate in responses.items():
+            response = self._ResponseType.__new__(self._ResponseType)
+            response.__setstate__(responsestate)
+            self.responses[moderator] = response
+
+    @classmethod
+    def from_state(cls, state: dict) -> ReddackItem:
+        """Create an item from the output of __getstate__."""
+        item = cls.__new__(cls)
+        item.__setstate__(state)
+        return item
+
+    def process_slack_responses(self, requests: list[tuple[dict, str]]): 
+        """Update responses from the sorted POST requests for this mod item."""
+        for request, timestamp in requests:
+            moderator = request['user']['id']
+            if moderator not in self.responses:
+                self.initialize_response(moderator)
+            self.responses[moderator].update(request, timestamp)
 
 class ReddackComment(ReddackItem):
     """Stores information about the state of a comment in the modqueue."""
 
+    kind : str = "comment"
+
 class ReddackSubmission(ReddackItem):
     """Stores information about the state of a submission in the modqueue."""
 
@@ -106,17 +142,20 @@ class ReddackSubmission(ReddackItem):
 
     def send_msg(self, client: WebClient, channel: str, removal_options: dict):
         """Send message for new mod item to specified Slack channel"""
+        payload = self.msg_payload(removal_options)
         try:
             result = client.chat_postMessage(
-                blocks=self.msg_payload(removal_options), channel=channel, 
+                blocks=payload, channel=channel, 
                 text="New modqueue item", unfurl_links=False, unfurl_media=False
             )
             result.validate()
             self.message_ts = result.data['ts']
         except SlackApiError as error:
+            # Retry without the thumbnail, which Slack rejects if it can't fetch it
+            payload = [block for block in payload if block.get("type") != "image"]
             try:
                 result = client.chat_postMessage(
-                    blocks=self.msg_payload(removal_options, thumbnail=False), channel=channel, 
+                    blocks=payload, channel=channel, 
                     text="New modqueue item", unfurl_links=False, unfurl_media=False
                 )
                 result.validate()
@@ -124,25 +163,33 @@ class ReddackSubmission(ReddackItem):
             except SlackApiError as error:
                 raise MsgSendError("Failed to send item to Slack.") from error
 
-    def _delete_msg(self, client: WebClient, user_client: WebClient, channel: str):
+    def delete_msg(self, client: WebClient, user_client: WebClient, channel: str):
         """Delete replies to mod item message"""
-        response = client.conversations_replies(
-            channel=channel, 
-            ts=self.message_ts
-        )
-        for message in response["messages"][::-1]:
-            reply_response = user_client.chat_delete(
+        # Iterating the response follows the cursor through every page, and
+        # each page repeats the parent message, so deduplicate in order
+        message_timestamps = list(dict.fromkeys(
+            message["ts"]
+            for page in client.conversations_replies(
+                channel=channel, 
+                ts=self.message_ts,
+                limit=REPLIES_PAGE_SIZE
+            )
+            for message in page["messages"]
+        ))
+        # Delete the parent last so Slack doesn't leave a "This message was
+        # deleted" stub; concurrency comes from cleaning up items in parallel
+        for message_ts in reversed(message_timestamps):
+            user_client.chat_delete(
                 channel=channel, 
-                ts=message["ts"],
+                ts=message_ts,
                 as_user=True
             )
 
-    def _send_archive(self, client: WebClient, channel: str):
+    def send_archive(self, client: WebClient, channel: str):
         """Send archive message after mod actions are complete"""
         responseblocks = []
         for userid, modresponse in self.responses.items():
-            response = client.users_info(user=userid)
-            name = response["user"]["real_name"]
+            name = _resolve_user_name(client, userid)
             responseblocks.append(
                 build_response_block(
                     name, 
@@ -157,29 +204,25 @@ class ReddackSubmission(ReddackItem):
             self.permalink,
             responseblocks = responseblocks,
         )
-        with open("debugdump.json", "w+") as f:
-            blocksjson = jsonpickle.encode(archiveblocks)
-            print(blocksjson, file=f)
+        if os.environ.get("REDDACK_DEBUG"):
+            with open("debugdump.json", "w+") as f:
+                json.dump(archiveblocks, f)
         result = client.chat_postMessage(
             blocks=archiveblocks, channel=channel,
             text="Archived modqueue item", unfurl_links=False, unfurl_media=False
         )
 
-    def complete_cleanup(self, client: WebClient, user_client: WebClient, channels: Channels):
-        """Delete message and send to archive after completion"""
-        self._delete_msg(client, user_client, channels['queue'])
-        self._send_archive(client, channels['archive'])
-
     def initialize_response(self, moderator: str):
         """Initialize a new moderator response object"""
         self.responses[moderator] = self._ResponseType(self.message_ts)
     
     def approve_or_remove(self, thresholds: Thresholds) -> str | None:
         """Decide whether to approve or remove item based on moderator votes and stored thresholds"""
-        votesum = 0
-        for response in self.responses.values():
-            if response.actions['actionConfirm'].value: 
-                votesum += float(response.states['actionApproveRemove'].value)
+        votesum = sum(
+            float(response.states['actionApproveRemove'].value)
+            for response in self.responses.values()
+            if response.actions['actionConfirm'].value
+        )
         if votesum >= thresholds['approve']:
             return 'approve'
         elif votesum <= thresholds['remove']:
@@ -187,7 +230,7 @@ class ReddackSubmission(ReddackItem):
         else:
             return None
     
-    def msg_payload(self, removal_options: dict, thumbnail: bool=True) -> dict:
+    def msg_payload(self, removal_options: dict) -> dict:
         "Create Slack message payload for the Submission"
         try:
             return build_submission_block(
@@ -195,7 +238,7 @@ class ReddackSubmission(ReddackItem):
                 self.title, 
                 self.url, 
                 self.author, 
-                self.thumbnail if thumbnail else thumbnail,
+                self.thumbnail,
                 self.text,
                 self.permalink,
                 removal_options
@@ -208,20 +251,25 @@ class ReddackSubmission(ReddackItem):
 
     @property
     def removal_reasons(self):
-        unique_reasons = []
-        for response in self.responses.values():
-            for reason in response.states['actionRemovalReason'].value:
-                if reason not in unique_reasons: unique_reasons.append(reason)
-        return sorted(unique_reasons)
+        return sorted({
+            reason 
+            for response in self.responses.values() 
+            for reason in response.states['actionRemovalReason'].value
+        })
 
     @property
     def modnote(self):
-        modnote = ""
-        timestamp = "0"
-        for response in self.responses.values():
-            if response.states['actionModnote'].timestamp > timestamp:
-                modnote = response.states['actionModnote'].value
-        return modnote
+        # Every interaction re-sends the modnote input, so ignore empty ones
+        latest = max(
+            (
+                response.states['actionModnote'] 
+                for response in self.responses.values()
+                if response.states['actionModnote'].value
+            ),
+            key=lambda state: float(state.timestamp),
+            default=None
+        )
+        return latest.value if latest is not None else ""
                 
 
 class Auth(abc.ABC):
@@ -276,10 +324,17 @@ class SlackAuth(Auth):
     def __init__(self, bot_token: str, user_token: str):
         self.bot_token = bot_token
         self.user_token = user_token
+        # Shared so CA certificates are loaded once, not on every request
+        self.ssl_context = ssl.create_default_context()
 
     def create_client(self, as_user: bool = False) -> WebClient:
         """Create an instance of the slack_sdk.WebClient using stored authenticators"""
-        return WebClient(token=(self.user_token if as_user else self.bot_token))
+        client = WebClient(
+            token=(self.user_token if as_user else self.bot_token),
+            ssl=self.ssl_context
+        )
+        client.retry_handlers.append(RateLimitErrorRetryHandler(max_retry_count=2))
+        return client
 
 class Thresholds(TypedDict):
     approve: int
@@ -300,6 +355,11 @@ class Rule(TypedDict):
     link: str
     applyto: str
 
+ITEM_TYPES: dict[str, Type[ReddackItem]] = {
+    ReddackSubmission.kind: ReddackSubmission,
+    ReddackComment.kind: ReddackComment
+}
+
 class Reddack:
     def __init__(self,
         subreddit_name: str,
@@ -332,23 +392,19 @@ class Reddack:
         self.removal_template = removal_template
         self.removal_options = build_removal_block(self.rules)
 
-    @property
-    def subreddit(self):
-        return self.praw_auth.create_client().subreddit(self.subreddit_name)
-
-    @property
+    @functools.cached_property
     def praw_client(self):
         return self.praw_auth.create_client()
 
-    @property
+    @functools.cached_property
     def slack_client(self):
         return self.slack_auth.create_client()
 
-    @property
+    @functools.cached_property
     def slack_user_client(self):
         return self.slack_auth.create_client(as_user=True)
 
-    @property
+    @functools.cached_property
     def subreddit(self):
         return self.praw_client.subreddit(self.subreddit_name)
     
@@ -356,74 +412,128 @@ class Reddack:
     def sync(self):
         """Sync the modqueue between Slack and Reddit"""
         # Load known items from JSON
-        knownitems = get_known_items(self.knownitems_path)
-        # Check Reddit modqueue for new items
-        newitems = self.check_reddit_queue(knownitems)
+        knownitems = get_known_items(self.knownitems_path, ITEM_TYPES)
+        # Retrieve Reddit modqueue once and check for new items
+        queueitems = self.retrieve_reddit_queue()
+        newitems = self.check_reddit_queue(knownitems, queueitems)
         # Update Slack modqueue with new items and remove orphaned items
         # TODO Add handling for case where Slack message has sent but something prevents item being added to knownitems, e.g title compare
-        knownitems = self.update_slack_queue(newitems, knownitems)
-        knownitems = self.remove_orphan_messages(knownitems)
+        try:
+            knownitems = self.update_slack_queue(newitems, knownitems)
+        finally:
+            # Items are added in place as they're sent, so save any that were
+            # posted even if another send failed
+            update_knownitems_file(knownitems, self.knownitems_path)
+        knownitems = self.remove_orphan_messages(knownitems, queueitems)
         update_knownitems_file(knownitems, self.knownitems_path)
         # Check Slack modqueue for moderator actions
         knownitems = self.check_slack_queue(knownitems)
         update_knownitems_file(knownitems, self.knownitems_path)
 
     def check_reddit_queue(self, 
-        knownitems: dict[str, ReddackItem]
+        knownitems: dict[str, ReddackItem],
+        queueitems: dict[str, ReddackItem] | None = None
     ) -> dict[str, ReddackItem]:
         """Check Reddit modqueue for unmoderated items"""
         newitems = {}
-        queueitems = self.retrieve_reddit_queue()
+        if queueitems is None:
+            queueitems = self.retrieve_reddit_queue()
         for id, moditem in queueitems.items():
-            isknown = True if id in knownitems else False
-            if isknown:
+            if id in knownitems:
                 continue
-            else:
-                newitems[id] = moditem
+            newitems[id] = moditem
         return newitems
 
     def retrieve_reddit_queue(self) -> dict[str, ReddackItem]:
         """Retrieve items from the Reddit queue"""
         queue = {}
-        for item in self.subreddit.mod.modqueue(limit=None):
-            # Check if item is comment or submission
-            if isinstance(item, Submission):
-                reddackitem = ReddackSubmission(item)
-            else:
-                print("Ignoring non-submission item.")
-                continue
-            queue[item.id] = reddackitem
+        # Comments are not yet supported, so filter them out server-side
+        for item in self.subreddit.mod.modqueue(limit=None, only="submissions"):
+            queue[item.id] = ReddackSubmission(item)
         return queue
 
-    def remove_orphan_messages(self, knownitems: dict[str, ReddackItem]):
+    def remove_orphan_messages(self, 
+        knownitems: dict[str, ReddackItem],
+        queueitems: dict[str, ReddackItem] | None = None
+    ):
         """Remove Slack queue messages for items no longer in Reddit modqueue"""
         unorphaned = {}
-        queueitems = self.retrieve_reddit_queue()
+        if queueitems is None:
+            queueitems = self.retrieve_reddit_queue()
+        orphaned = []
         for id, moditem in knownitems.items():
             if id not in queueitems:
-                moditem.complete_cleanup(
-                    self.slack_client, 
-                    self.slack_user_client, 
-                    self.channels[type(moditem)]
-                )
+                orphaned.append(moditem)
             else:
                 unorphaned[id] = moditem
+        try:
+            self.cleanup_items(orphaned)
+        finally:
+            # Orphans have left the Reddit modqueue, so stop tracking them even
+            # if their Slack cleanup failed
+            update_knownitems_file(unorphaned, self.knownitems_path)
         return unorphaned
 
+    def cleanup_items(self, moditems: list[ReddackItem]):
+        """Delete Slack queue messages concurrently, then archive items in order"""
+        item_channels = [self.channels[type(moditem)] for moditem in moditems]
+        error = None
+        with ThreadPoolExecutor(max_workers=CLEANUP_WORKERS) as executor:
+            futures = [
+                executor.submit(
+                    moditem.delete_msg,
+                    self.slack_client, 
+                    self.slack_user_client, 
+                    channels['queue']
+                )
+                for moditem, channels in zip(moditems, item_channels)
+            ]
+            # Archive every item whose message was deleted before raising the
+            # first failure, so no finished item is left without a record
+            for moditem, channels, future in zip(moditems, item_channels, futures):
+                try:
+                    future.result()
+                    moditem.send_archive(self.slack_client, channels['archive'])
+                except Exception as cleanuperror:
+                    if error is None:
+                        error = cleanuperror
+        if error is not None:
+            raise error
+
     def update_slack_queue(self, 
         newitems: dict[str, ReddackItem], 
         knownitems: dict[str, ReddackItem]
     ) -> dict[str, ReddackItem]:
         """Update the Slack modqueue with new Reddit modqueue items"""
         # TODO Detect when an item has been removed from the Reddit modqueue and remove it from Slack modqueue
-        for id, moditem in newitems.items():
-            moditem.send_msg(
-                self.slack_client, 
-                self.channels[type(moditem)]['queue'],
-                self.removal_options
-            )
+        queue_channels = {
+            itemtype: self.channels[itemtype]['queue'] 
+            for itemtype in {type(moditem) for moditem in newitems.values()}
+        }
+        with ThreadPoolExecutor(max_workers=SEND_WORKERS) as executor:
+            futures = {
+                id: executor.submit(
+                    moditem.send_msg,
+                    self.slack_client, 
+                    queue_channels[type(moditem)],
+                    self.removal_options
+                )
+                for id, moditem in newitems.items()
+            }
+        # Record every item that was sent, in modqueue order, before raising the
+        # first failure so the sent items aren't posted again on the next sync
+        error = None
+        for id, future in futures.items():
+            try:
+                future.result()
+            except Exception as senderror:
+                if error is None:
+                    error = senderror
+                continue
             # Add to known items
-            knownitems[id] = moditem
+            knownitems[id] = newitems[id]
+        if error is not None:
+            raise error
         return knownitems
         
     def send_removal_message(self, moditem: ReddackItem):
@@ -447,28 +557,34 @@ class Reddack:
         knownitems: dict[str, ReddackItem]
     ) -> dict[str, ReddackItem]:
         """Check Slack items for new moderation actions"""
-        incomplete = {}
         complete = {}
         if knownitems is None:
             knownitems = {}
-        for moditem in knownitems.values():
-            moditem.process_slack_responses(self.postrequest_path)
-            if moditem.approve_or_remove(self.thresholds[type(moditem)]) == "approve":
-                self.praw_client.submission(moditem.prawitem).mod.approve()
-            elif moditem.approve_or_remove(self.thresholds[type(moditem)]) == "remove":
-                self.praw_client.submission(moditem.prawitem).mod.remove()
-                self.send_removal_message(moditem)
-            else:
-                incomplete[moditem.prawitem] = moditem
-                continue
-            complete[moditem.prawitem] = moditem
-            moditem.complete_cleanup(
-                self.slack_client, 
-                self.slack_user_client, 
-                self.channels[type(moditem)]
-            )
-        cleanup_knownitems_json(incomplete, self.knownitems_path)
-        clean_post_request(incomplete, self.postrequest_path)
+        post_requests = scan_post_requests(self.postrequest_path)
+        try:
+            for id, moditem in knownitems.items():
+                moditem.process_slack_responses(post_requests.get(moditem.message_ts, []))
+                decision = moditem.approve_or_remove(self.thresholds[type(moditem)])
+                if decision == "approve":
+                    self.praw_client.submission(moditem.prawitem).mod.approve()
+                elif decision == "remove":
+                    self.praw_client.submission(moditem.prawitem).mod.remove()
+                    self.send_removal_message(moditem)
+                else:
+                    continue
+                complete[id] = moditem
+            # Reddit actions stay sequential as PRAW is not thread safe, but the
+            # Slack cleanup for finished items can overlap
+            self.cleanup_items(list(complete.values()))
+        finally:
+            # Stop tracking items once their Reddit action has happened, even if
+            # a later step failed, so they are never approved or removed twice
+            incomplete = {
+                id: moditem for id, moditem in knownitems.items() 
+                if id not in complete
+            }
+            cleanup_knownitems_json(incomplete, self.knownitems_path)
+        clean_post_request(incomplete, self.postrequest_path, post_requests)
         knownitems = incomplete
         return knownitems
 
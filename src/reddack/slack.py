@@ -81,6 +81,28 @@ class SubmissionResponse(ReddackResponse):
             'actionModnote' : Modnote()
             }
 
+    def __getstate__(self) -> dict:
+        """Return response state as plain JSON-serializable data."""
+        return {
+            'parentmsg_ts': self.parentmsg_ts,
+            'actions': {
+                actionid: dict(vars(action)) 
+                for actionid, action in self.actions.items()
+            },
+            'states': {
+                stateid: dict(vars(state)) 
+                for stateid, state in self.states.items()
+            }
+        }
+
+    def __setstate__(self, state: dict):
+        """Restore response state from the output of __getstate__."""
+        self.__init__(state['parentmsg_ts'])
+        for actionid, attributes in state['actions'].items():
+            vars(self.actions[actionid]).update(attributes)
+        for stateid, attributes in state['states'].items():
+            vars(self.states[stateid]).update(attributes)
+
     def update(self, request: dict, timestamp: str):
         """Update response with actions from Slack payload."""
         for action in request['actions']:
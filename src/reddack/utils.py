@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 # Native imports
 import json
 import os
@@ -5,19 +7,60 @@ from builtins import FileNotFoundError
 from pathlib import Path
 
 # 3rd party imports
-import jsonpickle
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Local imports
+from reddack.exceptions import (
+    KnownItemsError
+)
+
+_post_request_cache: dict[str, tuple[float, dict]] = {}
 
-def get_known_items(knownitems_path: Path) -> dict:
-    """Checks if item ID is in JSON file's list of known items"""
+def _json_loads(data: bytes):
+    """Deserialize JSON, using orjson if it is installed"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _json_dumps(obj) -> bytes:
+    """Serialize JSON to bytes, using orjson if it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+def get_known_items(knownitems_path: Path, item_types: dict[str, type]) -> dict:
+    """Load known items from JSON file, keyed by item ID"""
     # TODO Detect when message has been sent to Slack queue but not added to
     # the list of known modqueue items
     try:
-        with open(knownitems_path, 'r') as itemfile:
-            jsonstr = f'{itemfile.read()}'
-            knownitems = jsonpickle.decode(jsonstr)
+        with open(knownitems_path, 'rb') as itemfile:
+            jsonbytes = itemfile.read()
+        itemstates = _json_loads(jsonbytes)
     except (json.JSONDecodeError, FileNotFoundError):
-        knownitems = {}
-    return knownitems
+        return {}
+    if any(
+        isinstance(state, dict) and 'py/object' in state 
+        for state in itemstates.values()
+    ):
+        return _migrate_jsonpickle_items(jsonbytes, knownitems_path)
+    return {
+        id: item_types[state['kind']].from_state(state) 
+        for id, state in itemstates.items()
+    }
+
+def _migrate_jsonpickle_items(jsonbytes: bytes, knownitems_path: Path) -> dict:
+    """Load known items from a file written by jsonpickle in older versions"""
+    try:
+        import jsonpickle
+    except ImportError as error:
+        raise KnownItemsError(
+            f"{knownitems_path} was written by an older version of reddack.",
+            afterword="Install jsonpickle so it can be migrated to the new format."
+        ) from error
+    return jsonpickle.decode(jsonbytes.decode())
 
 def find_latest(message_ts: str, post_dir: Path) -> str:
     """Retrieves the latest POST request timestamp for a given message."""
@@ -39,24 +82,53 @@ def find_latest(message_ts: str, post_dir: Path) -> str:
     return latest_ts
 
 def update_knownitems_file(knownitems: dict, knownitems_path: Path):
-    with open(knownitems_path, 'w+') as itemfile:
-        jsonstr = jsonpickle.encode(knownitems)
-        print(jsonstr, file=itemfile)
+    """Write known items to JSON file"""
+    itemstates = {id: item.__getstate__() for id, item in knownitems.items()}
+    # Write to a temporary file first so a crash can't leave a partial file
+    tmp_path = f'{knownitems_path}.tmp'
+    with open(tmp_path, 'wb') as itemfile:
+        itemfile.write(_json_dumps(itemstates))
+    os.replace(tmp_path, knownitems_path)
 
-def clean_post_request(incomplete_items: dict, postrequest_path: Path):
+def scan_post_requests(postrequest_path: Path) -> dict[str, list[tuple[dict, str]]]:
+    """Retrieve all POST requests, keyed by message timestamp and sorted by 
+    request timestamp. Parsed files are cached until their mtime changes."""
+    post_requests = {}
+    with os.scandir(postrequest_path) as postfiles:
+        for postfile in postfiles:
+            if not postfile.name.endswith('.json'):
+                continue
+            mtime = postfile.stat().st_mtime
+            cached = _post_request_cache.get(postfile.path)
+            if cached is not None and cached[0] == mtime:
+                request = cached[1]
+            else:
+                with open(postfile.path, 'rb') as file:
+                    request = _json_loads(file.read())
+                _post_request_cache[postfile.path] = (mtime, request)
+            request_ts = postfile.name[:-len('.json')]
+            post_requests.setdefault(
+                request['container']['message_ts'], []
+            ).append((request, request_ts))
+    for requests in post_requests.values():
+        requests.sort(key=lambda z: z[1])
+    return post_requests
+
+def clean_post_request(
+    incomplete_items: dict, 
+    postrequest_path: Path, 
+    post_requests: dict[str, list[tuple[dict, str]]]
+):
     """Remove POST request files for completed items"""
-    keepjson_ts = []
-    for item in incomplete_items.values():
-        requests, timestamps = item.find_post_requests(postrequest_path)
-        if requests:
-            for request in requests:
-                keepjson_ts.append(request)
-    for postfile in postrequest_path.iterdir():
-        if postfile.stem not in keepjson_ts:
+    keep_message_ts = {item.message_ts for item in incomplete_items.values()}
+    for message_ts, requests in post_requests.items():
+        if message_ts in keep_message_ts:
+            continue
+        for request, request_ts in requests:
+            postfile = os.path.join(postrequest_path, f'{request_ts}.json')
+            _post_request_cache.pop(postfile, None)
             os.remove(postfile)
 
 def cleanup_knownitems_json(incomplete_items: dict, knownitems_path: Path):
     """Clean known item JSON"""
-    with open(knownitems_path, 'w+') as itemfile:
-        jsonstr = jsonpickle.encode(incomplete_items)
-        print(jsonstr, file=itemfile)
+    update_knownitems_file(incomplete_items, knownitems_path)